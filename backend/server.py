@@ -1,21 +1,31 @@
-from fastapi import FastAPI, APIRouter, HTTPException, BackgroundTasks, Depends
+from fastapi import FastAPI, APIRouter, HTTPException, BackgroundTasks, Depends, Request
+from fastapi.responses import StreamingResponse, PlainTextResponse, Response
 from fastapi.security import HTTPBasic, HTTPBasicCredentials
 from dotenv import load_dotenv
 from starlette.middleware.cors import CORSMiddleware
 from motor.motor_asyncio import AsyncIOMotorClient
+from pymongo.errors import OperationFailure
 import os
+import asyncio
+import json
 import logging
+import random
+from collections import deque
+from functools import reduce
 from pathlib import Path
 from pydantic import BaseModel, Field, EmailStr
 from typing import List, Optional, Dict, Any
 import uuid
-from datetime import datetime, timezone
+from datetime import datetime, timedelta, timezone
 from slugify import slugify
 import secrets
 from sendgrid import SendGridAPIClient
 from sendgrid.helpers.mail import Mail
 from passlib.context import CryptContext
 import bcrypt
+from pyinstrument import Profiler
+from pyinstrument.renderers import SpeedscopeRenderer
+from pyinstrument.session import Session
 
 ROOT_DIR = Path(__file__).parent
 load_dotenv(ROOT_DIR / '.env')
@@ -103,6 +113,7 @@ class CustomTest(BaseModel):
     creator_email: EmailStr
     questions: List[Question]
     share_token: str = Field(default_factory=lambda: secrets.token_urlsafe(32))
+    results_token: str = Field(default_factory=lambda: secrets.token_urlsafe(32))
     settings: Optional[Dict[str, Any]] = None
     is_active: bool = True
     created_at: datetime = Field(default_factory=lambda: datetime.now(timezone.utc))
@@ -202,7 +213,7 @@ async def create_custom_test(test: CustomTestCreate):
     await db.custom_tests.insert_one(test_obj.dict())
     return test_obj
 
-@api_router.get("/custom-tests/{share_token}", response_model=CustomTest)
+@api_router.get("/custom-tests/{share_token}", response_model=CustomTest, response_model_exclude={"results_token"})
 async def get_custom_test_by_token(share_token: str):
     test = await db.custom_tests.find_one({"share_token": share_token, "is_active": True})
     if not test:
@@ -227,12 +238,13 @@ async def submit_test_response(response: TestResponseCreate, background_tasks: B
                 test['creator_email'],
                 test['title'],
                 response.respondent_email,
-                response_obj.dict()
+                response_obj.dict(),
+                await ensure_results_token(test)
             )
     
     return {"status": "success", "message": "Ответы сохранены"}
 
-async def send_test_completion_notification(creator_email: str, test_title: str, respondent_email: str, response_data: dict):
+async def send_test_completion_notification(creator_email: str, test_title: str, respondent_email: str, response_data: dict, results_token: str):
     """Send notification to test creator about new response"""
     subject = f"Новый ответ на ваш тест: {test_title}"
     
@@ -252,6 +264,8 @@ async def send_test_completion_notification(creator_email: str, test_title: str,
                     <div style="white-space: pre-wrap;">{str(response_data['answers'])}</div>
                 </div>
                 
+                <p><strong>📊 Ключ для просмотра результатов в реальном времени:</strong> {results_token}</p>
+                
                 <div style="text-align: center; margin-top: 30px;">
                     <p style="color: #666;">Создайте свой тест на нашей платформе!</p>
                 </div>
@@ -265,6 +279,288 @@ async def send_test_completion_notification(creator_email: str, test_title: str,
     except EmailDeliveryError as e:
         print(f"Failed to send notification email: {e}")
 
+# Live results
+RESULTS_STREAM_QUEUE_SIZE = int(os.environ.get('RESULTS_STREAM_QUEUE_SIZE', '100'))
+RESULTS_STREAM_HEARTBEAT = 15  # seconds
+RESULTS_STREAM_RETRY_DELAY = 5  # seconds
+# Responses completed this long before a snapshot may still have their insert
+# event in flight, so their ids are remembered to avoid counting them twice.
+RESULTS_STREAM_DEDUP_WINDOW = timedelta(seconds=60)
+COUNTED_QUESTION_TYPES = {"single_choice", "multiple_choice", "scale"}
+CHANGE_STREAM_HISTORY_LOST = 286
+CHANGE_STREAM_UNSUPPORTED = 40573  # $changeStream on a standalone mongod
+
+def format_sse(event: str, data: dict) -> str:
+    """Encode a Server-Sent Events message"""
+    return f"event: {event}\ndata: {json.dumps(data, default=str, ensure_ascii=False)}\n\n"
+
+def tally_answers(counters: dict, questions: List[dict], answers: Dict[str, Any]):
+    """Add one response to the aggregate counters of a custom test"""
+    counters["total_responses"] += 1
+    for question in questions:
+        if question.get("type") not in COUNTED_QUESTION_TYPES:
+            continue
+        value = answers.get(question["id"])
+        if value is None:
+            continue
+        bucket = counters["answers"].setdefault(question["id"], {})
+        for option in value if isinstance(value, list) else [value]:
+            bucket[str(option)] = bucket.get(str(option), 0) + 1
+
+async def ensure_results_token(test: dict) -> str:
+    """Return the results token of a custom test, assigning one to tests created before it existed"""
+    if test.get('results_token'):
+        return test['results_token']
+    await db.custom_tests.update_one(
+        {"id": test['id'], "results_token": {"$exists": False}},
+        {"$set": {"results_token": secrets.token_urlsafe(32)}},
+    )
+    stored = await db.custom_tests.find_one({"id": test['id']}, {"_id": 0, "results_token": 1})
+    return stored['results_token']
+
+class ResultsSubscriber:
+    """A connected results dashboard with a bounded outgoing buffer"""
+
+    def __init__(self, test_id: str):
+        self.test_id = test_id
+        self.queue: asyncio.Queue = asyncio.Queue(maxsize=RESULTS_STREAM_QUEUE_SIZE)
+        self.closed = False
+
+    def push(self, message: str) -> bool:
+        try:
+            self.queue.put_nowait(message)
+            return True
+        except asyncio.QueueFull:
+            self.closed = True
+            return False
+
+    def close(self):
+        """Ask the dashboard to reconnect and fetch a fresh snapshot"""
+        self.closed = True
+        try:
+            self.queue.put_nowait(None)
+        except asyncio.QueueFull:
+            pass
+
+class ResultsChannel:
+    """Aggregate counters and connected dashboards of one custom test"""
+
+    def __init__(self, test: dict):
+        self.test_id = test['id']
+        self.questions = test.get('questions') or []
+        self.counters = {"total_responses": 0, "answers": {}}
+        self.subscribers: set = set()
+        self.ready = asyncio.Event()
+        self.failed = False
+        self.abandoned = False  # the dashboard building the snapshot went away
+        self.pending: List[dict] = []  # inserts seen while the snapshot is built
+        self.snapshot_ids: set = set()  # recent responses already in the snapshot
+
+class ResultsHub:
+    """Fans out new test responses to dashboards from one shared change stream.
+
+    The change stream on `test_responses` is opened when the first dashboard
+    connects and closed when the last one leaves. A test's snapshot is only
+    read once the stream is open; inserts arriving meanwhile are buffered on
+    the channel and merged without double counting. Dashboards that fall
+    RESULTS_STREAM_QUEUE_SIZE messages behind, or whose counters can no longer
+    be trusted, are disconnected so that EventSource reconnects for a fresh
+    snapshot.
+    """
+
+    def __init__(self):
+        self.channels: Dict[str, ResultsChannel] = {}
+        self.unavailable = False
+        self._task: Optional[asyncio.Task] = None
+        self._resume_token = None
+        self._watching = asyncio.Event()
+
+    async def subscribe(self, test: dict) -> Optional[ResultsSubscriber]:
+        while True:
+            channel = self.channels.get(test['id'])
+            if channel is None:
+                channel = ResultsChannel(test)
+                self.channels[test['id']] = channel
+                self._ensure_consumer()
+                try:
+                    await self._build_snapshot(channel)
+                except asyncio.CancelledError:
+                    # Let a dashboard still waiting for this test rebuild the snapshot
+                    channel.abandoned = True
+                    channel.ready.set()
+                    self._drop_channel(channel)
+                    raise
+                except Exception:
+                    channel.failed = True
+                    channel.ready.set()
+                    self._drop_channel(channel)
+                    raise
+            else:
+                await channel.ready.wait()
+                if channel.abandoned:
+                    continue
+            break
+        if channel.failed:
+            return None
+
+        subscriber = ResultsSubscriber(channel.test_id)
+        subscriber.push(format_sse("snapshot", {"counters": channel.counters}))
+        if self.unavailable:
+            subscriber.push(format_sse("unavailable", {"message": "Обновления в реальном времени недоступны"}))
+        if self.channels.get(channel.test_id) is channel:
+            channel.subscribers.add(subscriber)
+        else:
+            subscriber.close()
+        return subscriber
+
+    def unsubscribe(self, subscriber: ResultsSubscriber):
+        channel = self.channels.get(subscriber.test_id)
+        if channel is None:
+            return
+        channel.subscribers.discard(subscriber)
+        if not channel.subscribers:
+            self._drop_channel(channel)
+
+    def _ensure_consumer(self):
+        if not self.unavailable and (self._task is None or self._task.done()):
+            self._task = asyncio.create_task(self._consume())
+
+    def _drop_channel(self, channel: ResultsChannel):
+        if self.channels.get(channel.test_id) is channel:
+            del self.channels[channel.test_id]
+        if not self.channels:
+            self._stop_consumer()
+
+    def _stop_consumer(self):
+        # A later consumer starts from scratch: its dashboards take new
+        # snapshots, so replaying inserts from an old token would double count.
+        if self._task is not None and self._task is not asyncio.current_task():
+            self._task.cancel()
+        self._task = None
+        self._resume_token = None
+        if not self.unavailable:
+            # Without change streams no consumer will ever set a new event
+            self._watching = asyncio.Event()
+
+    def _reset_channels(self):
+        for channel in self.channels.values():
+            for subscriber in channel.subscribers:
+                subscriber.close()
+        self.channels.clear()
+        self._stop_consumer()
+
+    async def _build_snapshot(self, channel: ResultsChannel):
+        await self._watching.wait()
+        dedup_after = datetime.now(timezone.utc) - RESULTS_STREAM_DEDUP_WINDOW
+        cursor = db.test_responses.find(
+            {"test_id": channel.test_id, "test_type": "custom"},
+            {"_id": 0, "id": 1, "answers": 1, "completed_at": 1},
+        )
+        async for doc in cursor:
+            tally_answers(channel.counters, channel.questions, doc.get('answers') or {})
+            completed_at = doc.get('completed_at')
+            if completed_at is None or completed_at.replace(tzinfo=timezone.utc) >= dedup_after:
+                channel.snapshot_ids.add(doc.get('id'))
+
+        channel.ready.set()
+        pending, channel.pending = channel.pending, []
+        for doc in pending:
+            self._apply(channel, doc)
+
+    async def _consume(self):
+        pipeline = [{"$match": {"operationType": "insert", "fullDocument.test_type": "custom"}}]
+        while True:
+            try:
+                async with db.test_responses.watch(pipeline, resume_after=self._resume_token) as stream:
+                    if self._resume_token is None and self._watching.is_set():
+                        # Inserts since the previous stream are lost, so counters may be
+                        # stale; the next dashboard to reconnect starts a new consumer
+                        self._reset_channels()
+                        return
+                    self._resume_token = stream.resume_token
+                    self._watching.set()
+                    async for change in stream:
+                        self._resume_token = stream.resume_token
+                        self._dispatch(change['fullDocument'])
+            except asyncio.CancelledError:
+                raise
+            except OperationFailure as e:
+                if e.code == CHANGE_STREAM_UNSUPPORTED:
+                    logger.error("Live results need a MongoDB replica set; dashboards only receive snapshots")
+                    self.unavailable = True
+                    self._watching.set()
+                    return
+                if e.code == CHANGE_STREAM_HISTORY_LOST:
+                    logger.warning("Results change stream history lost, restarting from now")
+                    self._resume_token = None
+                    continue
+                logger.warning(f"Results change stream failed, retrying: {e}")
+                await asyncio.sleep(RESULTS_STREAM_RETRY_DELAY)
+            except Exception as e:
+                logger.warning(f"Results change stream failed, retrying: {e}")
+                await asyncio.sleep(RESULTS_STREAM_RETRY_DELAY)
+
+    def _dispatch(self, doc: dict):
+        channel = self.channels.get(doc.get('test_id'))
+        if channel is None:
+            return
+        if not channel.ready.is_set():
+            channel.pending.append(doc)
+            return
+        self._apply(channel, doc)
+
+    def _apply(self, channel: ResultsChannel, doc: dict):
+        if doc.get('id') in channel.snapshot_ids:
+            channel.snapshot_ids.discard(doc.get('id'))
+            return
+        tally_answers(channel.counters, channel.questions, doc.get('answers') or {})
+        message = format_sse("response", {
+            "response": {
+                "id": doc.get('id'),
+                "respondent_email": doc.get('respondent_email'),
+                "answers": doc.get('answers'),
+                "completed_at": doc.get('completed_at'),
+            },
+            "counters": channel.counters,
+        })
+        for subscriber in list(channel.subscribers):
+            if not subscriber.push(message):
+                channel.subscribers.discard(subscriber)
+
+results_hub = ResultsHub()
+
+async def results_event_stream(request: Request, test: dict):
+    subscriber = await results_hub.subscribe(test)
+    if subscriber is None:
+        yield format_sse("error", {"message": "Результаты временно недоступны"})
+        return
+    try:
+        yield f"retry: {RESULTS_STREAM_RETRY_DELAY * 1000}\n\n"
+        while not subscriber.closed:
+            try:
+                message = await asyncio.wait_for(subscriber.queue.get(), timeout=RESULTS_STREAM_HEARTBEAT)
+            except asyncio.TimeoutError:
+                if await request.is_disconnected():
+                    break
+                message = ": ping\n\n"
+            if message is None:
+                break
+            yield message
+    finally:
+        results_hub.unsubscribe(subscriber)
+
+@api_router.get("/custom-tests/results/{results_token}/stream")
+async def stream_custom_test_results(results_token: str, request: Request):
+    """Live feed of new responses and aggregate counters for the test creator"""
+    test = await db.custom_tests.find_one({"results_token": results_token})
+    if not test:
+        raise HTTPException(status_code=404, detail="Тест не найден")
+    return StreamingResponse(
+        results_event_stream(request, test),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
+
 # Admin routes
 @api_router.get("/admin/stats")
 async def get_admin_stats(admin: HTTPBasicCredentials = Depends(verify_admin_credentials)):
@@ -280,6 +576,127 @@ async def get_admin_stats(admin: HTTPBasicCredentials = Depends(verify_admin_cre
         "total_categories": total_categories
     }
 
+# Request profiling
+# Settings and collected profiles live in the worker process that serves the
+# request. Run a single uvicorn worker while profiling, or expect each worker
+# to be configured and sampled separately.
+PROFILE_HEADER = b"x-profile"
+PROFILE_TOKEN = os.environ.get('PROFILE_TOKEN')
+PROFILE_BUFFER_SIZE = int(os.environ.get('PROFILE_BUFFER_SIZE', '50'))
+
+class ProfilingSettings(BaseModel):
+    enabled: bool = False
+    sample_rate: float = Field(default=0.0, ge=0.0, le=1.0)
+    interval: float = Field(default=0.001, gt=0.0)
+
+profiling_settings = ProfilingSettings(
+    enabled=os.environ.get('PROFILING_ENABLED', '').lower() in ("1", "true", "yes"),
+    sample_rate=float(os.environ.get('PROFILING_SAMPLE_RATE', '0')),
+)
+profiled_sessions: Dict[str, deque] = {}
+
+def is_profile_requested(scope) -> bool:
+    """Whether the request carries `X-Profile: <PROFILE_TOKEN>`"""
+    if not PROFILE_TOKEN:
+        return False
+    value = dict(scope["headers"]).get(PROFILE_HEADER)
+    return value is not None and secrets.compare_digest(value, PROFILE_TOKEN.encode())
+
+class ProfilingMiddleware:
+    """Profile a sample of requests, or ones marked with the profiling token.
+
+    Nothing is profiled until an admin enables it, and while disabled the
+    middleware only checks a flag. Sessions are kept per matched route, so
+    requests that match no route are not stored.
+    """
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if not profiling_settings.enabled or scope["type"] != "http":
+            return await self.app(scope, receive, send)
+        if not is_profile_requested(scope) and random.random() >= profiling_settings.sample_rate:
+            return await self.app(scope, receive, send)
+
+        profiler = Profiler(interval=profiling_settings.interval, async_mode="enabled")
+        streaming = False
+
+        async def send_profiled(message):
+            nonlocal streaming
+            if message["type"] == "http.response.start" and not streaming:
+                content_type = dict(message.get("headers") or []).get(b"content-type", b"")
+                # Event streams stay open for the whole connection; profiling one
+                # would hold a session for hours and bury the route's samples.
+                if content_type.startswith(b"text/event-stream"):
+                    streaming = True
+                    profiler.stop()
+            await send(message)
+
+        profiler.start()
+        try:
+            await self.app(scope, receive, send_profiled)
+        finally:
+            if not streaming:
+                session = profiler.stop()
+                route = scope.get("route")
+                if route is not None:
+                    key = f"{scope['method']} {route.path}"
+                    profiled_sessions.setdefault(key, deque(maxlen=PROFILE_BUFFER_SIZE)).append(session)
+
+def fold_frames(frame, prefix: str, stacks: Dict[str, float]):
+    """Collect self time per call stack in Brendan Gregg's folded format"""
+    if frame.is_synthetic or not frame.file_path_short:
+        label = frame.function
+    else:
+        label = f"{frame.function} ({frame.file_path_short}:{frame.line_no})"
+    path = f"{prefix};{label}" if prefix else label
+    self_time = frame.time - sum(child.time for child in frame.children)
+    if self_time > 0:
+        stacks[path] = stacks.get(path, 0.0) + self_time
+    for child in frame.children:
+        fold_frames(child, path, stacks)
+
+@api_router.get("/admin/profiling")
+async def get_profiling_status(admin: HTTPBasicCredentials = Depends(verify_admin_credentials)):
+    """Profiling state of the worker process that serves this request"""
+    return {
+        "pid": os.getpid(),
+        "settings": profiling_settings.dict(),
+        "routes": {route: len(sessions) for route, sessions in profiled_sessions.items()},
+    }
+
+@api_router.put("/admin/profiling")
+async def update_profiling_settings(settings: ProfilingSettings, admin: HTTPBasicCredentials = Depends(verify_admin_credentials)):
+    global profiling_settings
+    profiling_settings = settings
+    return {"pid": os.getpid(), "settings": profiling_settings.dict()}
+
+@api_router.delete("/admin/profiling")
+async def clear_profiles(admin: HTTPBasicCredentials = Depends(verify_admin_credentials)):
+    profiled_sessions.clear()
+    return {"message": "Профили удалены"}
+
+@api_router.get("/admin/profiling/profile")
+async def download_profile(route: str, format: str = "folded", admin: HTTPBasicCredentials = Depends(verify_admin_credentials)):
+    """Download the aggregated profile of a route as folded stacks or speedscope JSON"""
+    sessions = list(profiled_sessions.get(route) or [])
+    if not sessions:
+        raise HTTPException(status_code=404, detail="Профиль не найден")
+    session = reduce(Session.combine, sessions)
+
+    if format == "speedscope":
+        return Response(content=SpeedscopeRenderer().render(session), media_type="application/json")
+    if format != "folded":
+        raise HTTPException(status_code=400, detail="Неизвестный формат профиля")
+
+    stacks: Dict[str, float] = {}
+    root_frame = session.root_frame()
+    if root_frame is not None:
+        fold_frames(root_frame, "", stacks)
+    lines = [f"{stack} {round(seconds * 1_000_000)}" for stack, seconds in stacks.items()]
+    return PlainTextResponse("\n".join(lines) + "\n")
+
 # Initialize default data
 @api_router.post("/admin/init-data")
 async def initialize_default_data(admin: HTTPBasicCredentials = Depends(verify_admin_credentials)):
@@ -389,6 +806,8 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
+app.add_middleware(ProfilingMiddleware)
+
 # Configure logging
 logging.basicConfig(
     level=logging.INFO,
@@ -0,0 +1,150 @@
+import asyncio
+from types import SimpleNamespace
+
+import pytest
+from fastapi.testclient import TestClient
+
+import server
+
+ADMIN = ("admin", "1234")
+
+
+def frame(function, time, children=(), file_path_short="server.py", line_no=1, is_synthetic=False):
+    return SimpleNamespace(
+        function=function, time=time, children=list(children),
+        file_path_short=file_path_short, line_no=line_no, is_synthetic=is_synthetic,
+    )
+
+
+def make_app(route_path="/api/items", content_type=b"application/json"):
+    async def app(scope, receive, send):
+        if route_path is not None:
+            scope["route"] = SimpleNamespace(path=route_path)
+        await send({"type": "http.response.start", "status": 200, "headers": [(b"content-type", content_type)]})
+        await send({"type": "http.response.body", "body": b"{}"})
+    return app
+
+
+def call(middleware, headers=()):
+    sent = []
+
+    async def receive():
+        return {"type": "http.request", "body": b""}
+
+    async def send(message):
+        sent.append(message)
+
+    scope = {"type": "http", "method": "GET", "path": "/api/items/42", "headers": list(headers)}
+    asyncio.run(middleware(scope, receive, send))
+    return sent
+
+
+@pytest.fixture(autouse=True)
+def profiling(monkeypatch):
+    monkeypatch.setattr(server, "profiling_settings", server.ProfilingSettings(enabled=True, sample_rate=0.0))
+    monkeypatch.setattr(server, "profiled_sessions", {})
+    monkeypatch.setattr(server, "PROFILE_TOKEN", "secret")
+
+
+def test_fold_frames_reports_self_time_per_stack():
+    root = frame("handler", 0.5, [
+        frame("find", 0.3, [frame("[await]", 0.3, file_path_short=None, is_synthetic=True)]),
+        frame("[self]", 0.2, file_path_short=None, is_synthetic=True),
+    ])
+    stacks = {}
+
+    server.fold_frames(root, "", stacks)
+
+    assert stacks == {
+        "handler (server.py:1);find (server.py:1);[await]": 0.3,
+        "handler (server.py:1);[self]": 0.2,
+    }
+
+
+def test_disabled_profiler_passes_requests_through(monkeypatch):
+    monkeypatch.setattr(server, "profiling_settings", server.ProfilingSettings(enabled=False, sample_rate=1.0))
+
+    sent = call(server.ProfilingMiddleware(make_app()), [(b"x-profile", b"secret")])
+
+    assert [message["type"] for message in sent] == ["http.response.start", "http.response.body"]
+    assert server.profiled_sessions == {}
+
+
+def test_sampled_requests_are_stored_per_route(monkeypatch):
+    monkeypatch.setattr(server, "profiling_settings", server.ProfilingSettings(enabled=True, sample_rate=1.0))
+
+    call(server.ProfilingMiddleware(make_app()))
+
+    assert list(server.profiled_sessions) == ["GET /api/items"]
+
+
+@pytest.mark.parametrize("headers, stored", [
+    ([], False),
+    ([(b"x-profile", b"1")], False),
+    ([(b"x-profile", b"secret")], True),
+])
+def test_profile_header_requires_token(headers, stored):
+    call(server.ProfilingMiddleware(make_app()), headers)
+
+    assert bool(server.profiled_sessions) is stored
+
+
+def test_profile_header_ignored_without_configured_token(monkeypatch):
+    monkeypatch.setattr(server, "PROFILE_TOKEN", None)
+
+    call(server.ProfilingMiddleware(make_app()), [(b"x-profile", b"secret")])
+
+    assert server.profiled_sessions == {}
+
+
+def test_unmatched_routes_are_not_stored():
+    call(server.ProfilingMiddleware(make_app(route_path=None)), [(b"x-profile", b"secret")])
+
+    assert server.profiled_sessions == {}
+
+
+def test_event_streams_are_not_stored():
+    sent = call(server.ProfilingMiddleware(make_app(content_type=b"text/event-stream")), [(b"x-profile", b"secret")])
+
+    assert len(sent) == 2
+    assert server.profiled_sessions == {}
+
+
+def test_sessions_per_route_are_bounded(monkeypatch):
+    monkeypatch.setattr(server, "PROFILE_BUFFER_SIZE", 2)
+    middleware = server.ProfilingMiddleware(make_app())
+
+    for _ in range(3):
+        call(middleware, [(b"x-profile", b"secret")])
+
+    assert len(server.profiled_sessions["GET /api/items"]) == 2
+
+
+@pytest.mark.parametrize("method, path", [
+    ("GET", "/api/admin/profiling"),
+    ("PUT", "/api/admin/profiling"),
+    ("DELETE", "/api/admin/profiling"),
+    ("GET", "/api/admin/profiling/profile?route=GET%20/api/"),
+])
+def test_profiling_endpoints_require_admin(method, path):
+    response = TestClient(server.app).request(method, path, auth=("admin", "wrong"))
+
+    assert response.status_code == 401
+
+
+def test_download_profile_of_profiled_route():
+    client = TestClient(server.app)
+    assert client.get("/api/", headers={"X-Profile": "secret"}).status_code == 200
+
+    status = client.get("/api/admin/profiling", auth=ADMIN).json()
+    folded = client.get("/api/admin/profiling/profile", params={"route": "GET /api/"}, auth=ADMIN)
+    speedscope = client.get(
+        "/api/admin/profiling/profile", params={"route": "GET /api/", "format": "speedscope"}, auth=ADMIN
+    )
+
+    assert status["routes"] == {"GET /api/": 1}
+    assert folded.status_code == 200
+    assert folded.headers["content-type"].startswith("text/plain")
+    assert speedscope.status_code == 200
+    assert "speedscope" in speedscope.json()["$schema"]
+    assert client.get("/api/admin/profiling/profile", params={"route": "GET /missing"}, auth=ADMIN).status_code == 404
@@ -0,0 +1,352 @@
+import asyncio
+import json
+from datetime import datetime, timedelta, timezone
+
+from fastapi.testclient import TestClient
+from pymongo.errors import OperationFailure
+
+import server
+
+QUESTIONS = [
+    {"id": "q1", "type": "single_choice"},
+    {"id": "q2", "type": "multiple_choice"},
+    {"id": "q3", "type": "scale"},
+    {"id": "q4", "type": "text"},
+]
+TEST = {"id": "t1", "questions": QUESTIONS}
+
+
+class FakeCursor:
+    def __init__(self, docs):
+        self.docs = list(docs)
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        if not self.docs:
+            raise StopAsyncIteration
+        return self.docs.pop(0)
+
+
+class BlockingCursor(FakeCursor):
+    def __init__(self, docs, release):
+        super().__init__(docs)
+        self.release = release
+
+    async def __anext__(self):
+        await self.release.wait()
+        return await super().__anext__()
+
+
+class FakeCollection:
+    def __init__(self, docs=None, on_find=None):
+        self.docs = docs or []
+        self.on_find = on_find
+
+    def find(self, query, projection=None):
+        if self.on_find:
+            self.on_find()
+        return FakeCursor(self.docs)
+
+    async def find_one(self, query, projection=None):
+        return self.docs[0] if self.docs else None
+
+
+class FakeChangeStream:
+    def __init__(self, changes):
+        self.changes = list(changes)
+        self.resume_token = {"_data": "fresh"}
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc):
+        return False
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        if not self.changes:
+            await asyncio.sleep(60)
+        return self.changes.pop(0)
+
+
+class FailingWatchCollection(FakeCollection):
+    def __init__(self, *errors, changes=()):
+        super().__init__()
+        self.errors = list(errors)
+        self.changes = changes
+        self.resume_after = []
+
+    def watch(self, pipeline, resume_after=None):
+        self.resume_after.append(resume_after)
+        if self.errors:
+            raise self.errors.pop(0)
+        return FakeChangeStream(self.changes)
+
+
+class FakeDB:
+    def __init__(self, **collections):
+        self.__dict__.update(collections)
+
+
+def drain(subscriber):
+    messages = []
+    while not subscriber.queue.empty():
+        messages.append(subscriber.queue.get_nowait())
+    return messages
+
+
+def event_data(message):
+    return json.loads(message.split("data: ", 1)[1])
+
+
+def ready_channel(hub):
+    channel = server.ResultsChannel(TEST)
+    channel.ready.set()
+    hub.channels[TEST["id"]] = channel
+    return channel
+
+
+def test_format_sse():
+    assert server.format_sse("response", {"a": "б"}) == 'event: response\ndata: {"a": "б"}\n\n'
+
+
+def test_tally_answers_counts_choice_and_scale_questions():
+    counters = {"total_responses": 0, "answers": {}}
+    server.tally_answers(counters, QUESTIONS, {"q1": "Да", "q2": ["A", "B"], "q3": 7, "q4": "free text"})
+    server.tally_answers(counters, QUESTIONS, {"q1": "Да", "q2": ["B"]})
+
+    assert counters == {
+        "total_responses": 2,
+        "answers": {"q1": {"Да": 2}, "q2": {"A": 1, "B": 2}, "q3": {"7": 1}},
+    }
+
+
+def test_subscriber_push_is_bounded(monkeypatch):
+    async def run():
+        monkeypatch.setattr(server, "RESULTS_STREAM_QUEUE_SIZE", 2)
+        subscriber = server.ResultsSubscriber("t1")
+        assert subscriber.push("a") and subscriber.push("b")
+        assert not subscriber.push("c")
+        assert subscriber.closed
+        assert drain(subscriber) == ["a", "b"]
+
+    asyncio.run(run())
+
+
+def test_dispatch_fans_out_to_subscribers_of_the_test(monkeypatch):
+    async def run():
+        monkeypatch.setattr(server, "RESULTS_STREAM_QUEUE_SIZE", 1)
+        hub = server.ResultsHub()
+        channel = ready_channel(hub)
+        first, second, slow = (server.ResultsSubscriber("t1") for _ in range(3))
+        slow.push("backlog")
+        channel.subscribers.update({first, second, slow})
+
+        hub._dispatch({"id": "r1", "test_id": "t1", "answers": {"q1": "Да"}})
+        hub._dispatch({"id": "r2", "test_id": "other", "answers": {"q1": "Да"}})
+
+        for subscriber in (first, second):
+            (message,) = drain(subscriber)
+            assert message.startswith("event: response\n")
+            data = event_data(message)
+            assert data["response"]["id"] == "r1"
+            assert data["counters"] == {"total_responses": 1, "answers": {"q1": {"Да": 1}}}
+        assert slow.closed
+        assert channel.subscribers == {first, second}
+
+    asyncio.run(run())
+
+
+def test_dispatch_skips_responses_already_in_snapshot():
+    async def run():
+        hub = server.ResultsHub()
+        channel = ready_channel(hub)
+        channel.snapshot_ids.add("r1")
+
+        hub._dispatch({"id": "r1", "test_id": "t1", "answers": {}})
+        hub._dispatch({"id": "r2", "test_id": "t1", "answers": {}})
+
+        assert channel.counters["total_responses"] == 1
+        assert channel.snapshot_ids == set()
+
+    asyncio.run(run())
+
+
+def test_snapshot_merges_inserts_seen_while_building(monkeypatch):
+    async def run():
+        hub = server.ResultsHub()
+        hub._watching.set()
+        hub._ensure_consumer = lambda: None
+        now = datetime.now(timezone.utc)
+        old = now - timedelta(days=1)
+
+        def insert_during_find():
+            # r2 is both in the snapshot and on the stream, r3 only on the stream
+            hub._dispatch({"id": "r2", "test_id": "t1", "answers": {"q1": "B"}})
+            hub._dispatch({"id": "r3", "test_id": "t1", "answers": {"q1": "C"}})
+
+        monkeypatch.setattr(server, "db", FakeDB(test_responses=FakeCollection(
+            [
+                {"id": "r1", "answers": {"q1": "A"}, "completed_at": old},
+                {"id": "r2", "answers": {"q1": "B"}, "completed_at": now},
+            ],
+            on_find=insert_during_find,
+        )))
+
+        subscriber = await hub.subscribe(TEST)
+        (snapshot,) = drain(subscriber)
+
+        assert snapshot.startswith("event: snapshot\n")
+        assert event_data(snapshot)["counters"] == {
+            "total_responses": 3,
+            "answers": {"q1": {"A": 1, "B": 1, "C": 1}},
+        }
+        assert hub.channels["t1"].subscribers == {subscriber}
+
+    asyncio.run(run())
+
+
+def test_last_unsubscribe_forgets_resume_token(monkeypatch):
+    async def run():
+        hub = server.ResultsHub()
+        hub._watching.set()
+        hub._task = asyncio.create_task(asyncio.sleep(60))
+        hub._resume_token = {"_data": "token"}
+        monkeypatch.setattr(server, "db", FakeDB(test_responses=FakeCollection()))
+
+        subscriber = await hub.subscribe(TEST)
+        task = hub._task
+        hub.unsubscribe(subscriber)
+        await asyncio.sleep(0)
+
+        assert hub.channels == {}
+        assert task.cancelled()
+        assert hub._task is None and hub._resume_token is None
+        assert not hub._watching.is_set()
+
+    asyncio.run(run())
+
+
+def test_reset_channels_closes_subscribers():
+    async def run():
+        hub = server.ResultsHub()
+        channel = ready_channel(hub)
+        subscriber = server.ResultsSubscriber("t1")
+        channel.subscribers.add(subscriber)
+
+        hub._reset_channels()
+
+        assert hub.channels == {}
+        assert subscriber.closed
+        assert drain(subscriber) == [None]
+
+    asyncio.run(run())
+
+
+def test_public_custom_test_hides_results_token(monkeypatch):
+    test = server.CustomTest(
+        title="Test", description="Description", creator_email="creator@example.com", questions=[]
+    ).dict()
+    monkeypatch.setattr(server, "db", FakeDB(custom_tests=FakeCollection([test])))
+
+    response = TestClient(server.app).get(f"/api/custom-tests/{test['share_token']}")
+
+    assert response.status_code == 200
+    assert "results_token" not in response.json()
+    assert response.json()["share_token"] == test["share_token"]
+
+
+def test_standalone_mongod_marks_feed_unavailable(monkeypatch, caplog):
+    async def run():
+        hub = server.ResultsHub()
+        monkeypatch.setattr(server, "db", FakeDB(test_responses=FailingWatchCollection(
+            OperationFailure("not a replica set", server.CHANGE_STREAM_UNSUPPORTED)
+        )))
+
+        await hub._consume()
+
+        assert hub.unavailable and hub._watching.is_set()
+        hub._ensure_consumer()
+        assert hub._task is None
+
+    with caplog.at_level("ERROR"):
+        asyncio.run(run())
+    assert [record.levelname for record in caplog.records] == ["ERROR"]
+
+
+def test_lost_history_restarts_stream_without_resume_token(monkeypatch):
+    async def run():
+        hub = server.ResultsHub()
+        hub._resume_token = {"_data": "expired"}
+        channel = ready_channel(hub)
+        subscriber = server.ResultsSubscriber("t1")
+        channel.subscribers.add(subscriber)
+        collection = FailingWatchCollection(
+            OperationFailure("history lost", server.CHANGE_STREAM_HISTORY_LOST)
+        )
+        monkeypatch.setattr(server, "db", FakeDB(test_responses=collection))
+        hub._watching.set()
+
+        hub._task = task = asyncio.create_task(hub._consume())
+        await asyncio.sleep(0.01)
+
+        assert collection.resume_after == [{"_data": "expired"}, None]
+        assert subscriber.closed and hub.channels == {}
+        # Nobody is listening any more, so the stream is closed until the next dashboard
+        assert task.done() and not task.cancelled()
+        assert hub._task is None and hub._resume_token is None
+        assert not hub._watching.is_set()
+
+    asyncio.run(run())
+
+
+def test_standalone_mongod_keeps_serving_snapshots_after_resubscribe(monkeypatch):
+    async def run():
+        hub = server.ResultsHub()
+        collection = FailingWatchCollection(
+            OperationFailure("not a replica set", server.CHANGE_STREAM_UNSUPPORTED)
+        )
+        collection.docs = [{"id": "r1", "answers": {"q1": "A"}}]
+        monkeypatch.setattr(server, "db", FakeDB(test_responses=collection))
+
+        first = await asyncio.wait_for(hub.subscribe(TEST), timeout=1)
+        assert [m.split("\n", 1)[0] for m in drain(first)] == ["event: snapshot", "event: unavailable"]
+        hub.unsubscribe(first)
+
+        second = await asyncio.wait_for(hub.subscribe(TEST), timeout=1)
+        assert [m.split("\n", 1)[0] for m in drain(second)] == ["event: snapshot", "event: unavailable"]
+
+    asyncio.run(run())
+
+
+def test_waiting_dashboard_rebuilds_snapshot_when_builder_disconnects(monkeypatch):
+    async def run():
+        hub = server.ResultsHub()
+        # Stand-in for a consumer whose change stream opens immediately
+        hub._ensure_consumer = lambda: hub._watching.set()
+        release = asyncio.Event()
+        collection = FakeCollection([{"id": "r1", "answers": {"q1": "A"}}])
+        cursors = iter([BlockingCursor([], asyncio.Event()), BlockingCursor(collection.docs, release)])
+        collection.find = lambda query, projection=None: next(cursors)
+        monkeypatch.setattr(server, "db", FakeDB(test_responses=collection))
+
+        builder = asyncio.create_task(hub.subscribe(TEST))
+        await asyncio.sleep(0)
+        waiter = asyncio.create_task(hub.subscribe(TEST))
+        await asyncio.sleep(0)
+        builder.cancel()
+        await asyncio.sleep(0)
+        release.set()
+        subscriber = await asyncio.wait_for(waiter, timeout=1)
+
+        assert builder.cancelled()
+        assert subscriber is not None
+        (snapshot,) = drain(subscriber)
+        assert event_data(snapshot)["counters"]["total_responses"] == 1
+        assert hub.channels["t1"].subscribers == {subscriber}
+
+    asyncio.run(run())